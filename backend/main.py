@@ -1,47 +1,115 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
 import os
+import threading
 from datetime import datetime, timedelta, timezone
 from typing import List
 
+import jwt
 import sqlalchemy
-from fastapi import Depends, FastAPI, HTTPException, status, Form
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
 from passlib.context import CryptContext
-from pydantic import BaseModel, EmailStr
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from pydantic import AliasChoices, BaseModel, ConfigDict, EmailStr, Field
+from sqlalchemy import create_engine, event, func, lambda_stmt, select, update, delete, Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.pool import QueuePool
 
 # --- CONFIGURATION ---
 DATABASE_URL = "sqlite:///./notes.db"
 SECRET_KEY = "a_very_secret_key_for_jwt"  # In production, use a more secure key and load from env
 ALGORITHM = "HS256"
+JWT_ALGORITHMS = (ALGORITHM,)
+JWT_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_aud": False}
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+USER_CACHE_TTL_SECONDS = 30
+WRITE_BATCH_SIZE = 500  # Max queued note writes committed in one transaction
+
+logger = logging.getLogger("uvicorn.error")
 
 # --- DATABASE SETUP ---
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Long-lived pooled connections keep SQLite's page cache warm between requests
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=10,
+    max_overflow=20,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    query_cache_size=1200,
+)
+
+# WAL lets readers run alongside the single writer, and synchronous=NORMAL only
+# fsyncs at checkpoints instead of on every commit.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA cache_size=-65536",  # 64 MiB page cache
+    "PRAGMA busy_timeout=5000",
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Disable pysqlite's own transaction handling so BEGIN is emitted below
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+@event.listens_for(engine, "begin")
+def begin_sqlite_transaction(conn):
+    # Writers opt into BEGIN IMMEDIATE to take the write lock up front
+    if conn.get_execution_options().get("sqlite_begin_immediate"):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        conn.exec_driver_sql("BEGIN")
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sessions for the background writer take SQLite's write lock at BEGIN
+WriterSession = sessionmaker(
+    autocommit=False, autoflush=False, bind=engine.execution_options(sqlite_begin_immediate=True)
+)
 Base = declarative_base()
 
 # --- DATABASE MODELS (SQLAlchemy) ---
+def sql_utc_now():
+    # Evaluated by SQLite inside the INSERT/UPDATE; CURRENT_TIMESTAMP alone only has second precision
+    return func.strftime("%Y-%m-%d %H:%M:%f", "now")
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    notes = relationship("Note", back_populates="owner", cascade="all, delete-orphan")
+    # Relationships are never lazy-loaded; any accidental N+1 access raises instead
+    notes = relationship("Note", back_populates="owner", cascade="all, delete-orphan", lazy="raise_on_sql")
 
 class Note(Base):
     __tablename__ = "notes"
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
     content = Column(String)
-    created_on = Column(DateTime, default=lambda: datetime.now(timezone.utc))
-    last_update = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    created_on = Column(DateTime, default=sql_utc_now())
+    last_update = Column(DateTime, default=sql_utc_now(), onupdate=sql_utc_now())
     owner_id = Column(Integer, ForeignKey("users.id"))
-    owner = relationship("User", back_populates="notes")
+    owner = relationship("User", back_populates="notes", lazy="raise_on_sql")
+
+    __table_args__ = (
+        # Single index seek for the per-owner lookups in update/delete and listing
+        Index("ix_notes_owner_id_id", "owner_id", "id"),
+        Index("ix_notes_owner_id_last_update", "owner_id", last_update.desc()),
+    )
 
 
 # --- PYDANTIC SCHEMAS (Data Validation) ---
@@ -58,14 +126,11 @@ class NoteUpdate(NoteBase):
 
 class NoteSchema(NoteBase):
     id: int
-    userId: int # Mapped from owner_id
+    userId: int = Field(validation_alias=AliasChoices("userId", "owner_id"))
     created_on: datetime
     last_update: datetime
 
-    class Config:
-        orm_mode = True
-        # Pydantic V2 uses `from_attributes` instead of `orm_mode`
-        # from_attributes = True 
+    model_config = ConfigDict(from_attributes=True)
 
 # User Schemas
 class UserBase(BaseModel):
@@ -78,8 +143,7 @@ class UserCreate(UserBase):
 class UserSchema(UserBase):
     id: int
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Token Schemas
 class Token(BaseModel):
@@ -90,17 +154,15 @@ class TokenData(BaseModel):
     email: str | None = None
 
 # --- SECURITY UTILS ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Cost 10 keeps a hash around 70ms; bcrypt>=4 (pinned in requirements) is the native Rust backend
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=10, deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    # Truncate password to 72 bytes for bcrypt compatibility
-    # Ensure we don't exceed bcrypt's 72-byte limit
-    password_bytes = password.encode('utf-8')[:72]
-    return pwd_context.hash(password_bytes.decode('utf-8', errors='ignore'))
+    return pwd_context.hash(password)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -122,83 +184,239 @@ def get_db():
         db.close()
 
 # User CRUD
+# Hot queries are lambda statements so their compiled SQL is cached per call site
 def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+    stmt = lambda_stmt(lambda: select(User).where(User.email == email))
+    return db.execute(stmt).scalar_one_or_none()
+
+# Users seen during token validation, keyed by email. Only UserSchema snapshots
+# (no password hash) are kept, and the cache is shared by FastAPI's worker threads.
+user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+user_cache_lock = threading.Lock()
+
+def get_cached_user(db: Session, email: str):
+    with user_cache_lock:
+        user = user_cache.get(email)
+    if user is not None:
+        return user
+    db_user = get_user_by_email(db, email)
+    if db_user is None:
+        return None
+    user = UserSchema.model_validate(db_user)
+    with user_cache_lock:
+        user_cache[email] = user
+    return user
+
+def invalidate_cached_user(email: str):
+    with user_cache_lock:
+        user_cache.pop(email, None)
 
 def create_user(db: Session, user: UserCreate):
+    # One atomic INSERT; returns None instead of a row when the email is taken
     hashed_password = get_password_hash(user.password)
-    db_user = User(email=user.email, hashed_password=hashed_password, username=user.username)
-    db.add(db_user)
+    stmt = (
+        sqlite_insert(User)
+        .values(email=user.email, hashed_password=hashed_password, username=user.username)
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(User.id, User.username, User.email)
+    )
+    row = db.execute(stmt).first()
     db.commit()
-    db.refresh(db_user)
-    return db_user
+    if row is None:
+        return None
+    invalidate_cached_user(user.email)
+    return UserSchema.model_validate(row)
+
+def verify_and_upgrade_password(db: Session, user: User, plain_password: str):
+    # Re-hash with the current settings (e.g. older cost-12 bcrypt) after a successful login
+    verified, new_hash = pwd_context.verify_and_update(plain_password, user.hashed_password)
+    if verified and new_hash is not None:
+        db.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(hashed_password=new_hash)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    return verified
 
 # Note CRUD
 def get_notes_for_user(db: Session, user_id: int):
-    return db.query(Note).filter(Note.owner_id == user_id).all()
+    # Plain rows instead of ORM objects, skipping the identity map
+    stmt = lambda_stmt(
+        lambda: select(
+            Note.id,
+            Note.title,
+            Note.content,
+            Note.created_on,
+            Note.last_update,
+            Note.owner_id,
+        ).where(Note.owner_id == user_id)
+    )
+    return db.execute(stmt).all()
+
+def get_notes_etag(db: Session, user_id: int):
+    # Writes in one batch can share a millisecond, so max(last_update) alone can miss
+    # an update; the sum of all timestamps moves whenever any note's last_update does.
+    # Everything comes from the (owner_id, last_update) index without touching rows.
+    stmt = lambda_stmt(
+        lambda: select(
+            func.count(),
+            func.max(Note.last_update),
+            func.total(func.julianday(Note.last_update)),
+        ).where(Note.owner_id == user_id)
+    )
+    count, last_update, last_update_total = db.execute(stmt).one()
+    digest = hashlib.blake2b(
+        f"{user_id}:{count}:{last_update}:{last_update_total!r}".encode(), digest_size=16
+    )
+    return f'W/"{digest.hexdigest()}"'
+
+def etag_matches(if_none_match: str, etag: str):
+    # If-None-Match uses weak comparison (RFC 9110), so ignore any W/ prefix
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(",")
+    )
 
+# Write helpers only flush; NoteWriter commits them together in batches
 def create_note_for_user(db: Session, note: NoteCreate, user_id: int):
-    db_note = Note(**note.dict(), owner_id=user_id)
+    db_note = Note(**note.model_dump(), owner_id=user_id)
     db.add(db_note)
-    db.commit()
-    db.refresh(db_note)
-    # Manually create the response object to match the schema
-    return NoteSchema(
-        id=db_note.id,
-        title=db_note.title,
-        content=db_note.content,
-        created_on=db_note.created_on,
-        last_update=db_note.last_update,
-        userId=db_note.owner_id
-    )
+    db.flush()
+    return NoteSchema.model_validate(db_note)
 
 def update_note(db: Session, note_id: int, note_update: NoteUpdate, user_id: int):
-    db_note = db.query(Note).filter(Note.id == note_id, Note.owner_id == user_id).first()
-    if db_note:
-        db_note.title = note_update.title
-        db_note.content = note_update.content
-        db.commit()
-        db.refresh(db_note)
-        return NoteSchema(
-            id=db_note.id,
-            title=db_note.title,
-            content=db_note.content,
-            created_on=db_note.created_on,
-            last_update=db_note.last_update,
-            userId=db_note.owner_id
+    # Single UPDATE ... RETURNING instead of SELECT, mutate, flush
+    stmt = (
+        update(Note)
+        .where(Note.id == note_id, Note.owner_id == user_id)
+        .values(
+            title=note_update.title,
+            content=note_update.content,
         )
-    return None
+        .returning(Note.id, Note.title, Note.content, Note.created_on, Note.last_update, Note.owner_id)
+        .execution_options(synchronize_session=False)
+    )
+    row = db.execute(stmt).first()
+    if row is None:
+        return None
+    return NoteSchema.model_validate(row)
 
 def delete_note(db: Session, note_id: int, user_id: int):
-    db_note = db.query(Note).filter(Note.id == note_id, Note.owner_id == user_id).first()
-    if db_note:
-        db.delete(db_note)
-        db.commit()
-        return True
-    return False
+    stmt = (
+        delete(Note)
+        .where(Note.id == note_id, Note.owner_id == user_id)
+        .returning(Note.id)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).first() is not None
+
+# --- BACKGROUND WRITER ---
+def apply_write_batch(batch):
+    """Run queued write helpers in one transaction, isolating each in a savepoint."""
+    results = []
+    with WriterSession() as db, db.begin():
+        for write_fn, kwargs in batch:
+            try:
+                with db.begin_nested():
+                    results.append((write_fn(db, **kwargs), None))
+            except Exception as exc:
+                results.append((None, exc))
+    return results
+
+class NoteWriter:
+    """Serializes note writes through a single task so SQLite never sees competing writers."""
+
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._writing = False
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:  # startup failed before start() ran
+            return
+        self._stopping = True
+        # A batch already in its worker thread is left to finish so its callers get
+        # the real outcome; the loop exits after it. An idle writer is cancelled.
+        if not self._writing:
+            self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("writer stopped"))
+
+    async def submit(self, write_fn, **kwargs):
+        if self._task is None or self._stopping:
+            raise RuntimeError("writer stopped")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((write_fn, kwargs, future))
+        return await future
+
+    async def _run(self):
+        while not self._stopping:
+            # Block for one item, then take whatever else is already waiting
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._writing = True
+            try:
+                results = await asyncio.to_thread(
+                    apply_write_batch, [(write_fn, kwargs) for write_fn, kwargs, _ in batch]
+                )
+            except Exception as exc:
+                # The commit itself failed, so nothing in the batch was written
+                results = [(None, exc)] * len(batch)
+            finally:
+                self._writing = False
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():  # caller went away
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+note_writer = NoteWriter()
+
 
 # --- AUTHENTICATION DEPENDENCY ---
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# Plain `def` so FastAPI runs the blocking DB lookup on its threadpool
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=JWT_ALGORITHMS, options=JWT_DECODE_OPTIONS)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
         token_data = TokenData(email=email)
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise credentials_exception
-    user = get_user_by_email(db, email=token_data.email)
+    user = get_cached_user(db, email=token_data.email)
     if user is None:
         raise credentials_exception
     return user
 
 
 # --- FASTAPI APP INITIALIZATION ---
+# Keep the default response class: with a response_model set, FastAPI serializes
+# straight to JSON bytes in pydantic-core, which a custom class would bypass
 app = FastAPI(title="Keep Notes API")
 
 # CORS Middleware Setup
@@ -214,21 +432,47 @@ app.add_middleware(
 # --- API ENDPOINTS ---
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
-    # Create demo user if they don't exist
-    db = SessionLocal()
-    demo_user = get_user_by_email(db, "deva@example.com")
-    if not demo_user:
-        create_user(db, UserCreate(username="deva", email="deva@example.com", password="password123"))
-    db.close()
+    # Create the schema and the demo user in a single write transaction
+    with engine.execution_options(sqlite_begin_immediate=True).begin() as conn:
+        Base.metadata.create_all(bind=conn)
+        # create_all skips indexes on tables that already exist
+        for index in Note.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+        # Only pay for the password hash when the demo user is actually missing
+        demo_exists = conn.execute(
+            select(User.id).where(User.email == "deva@example.com")
+        ).first()
+        if demo_exists is None:
+            conn.execute(
+                sqlite_insert(User)
+                .values(
+                    username="deva",
+                    email="deva@example.com",
+                    hashed_password=get_password_hash("password123"),
+                )
+                .on_conflict_do_nothing(index_elements=["email"])
+            )
+        # Refresh planner statistics so SQLite picks up the composite indexes
+        conn.exec_driver_sql("ANALYZE")
+    logger.info("Database pool ready: %s", engine.pool.status())
+
+
+@app.on_event("startup")
+async def start_note_writer():
+    note_writer.start()
+
+
+@app.on_event("shutdown")
+async def stop_note_writer():
+    await note_writer.stop()
 
 
 @app.post("/signup", response_model=UserSchema, status_code=status.HTTP_201_CREATED)
 def signup(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = get_user_by_email(db, email=user.email)
-    if db_user:
+    db_user = create_user(db=db, user=user)
+    if db_user is None:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return create_user(db=db, user=user)
+    return db_user
 
 
 @app.post("/login", response_model=Token)
@@ -236,8 +480,12 @@ async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
 ):
     # The frontend sends email in the 'username' field of the form
-    user = get_user_by_email(db, email=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    # Both the lookup and the hash check block, so keep them off the event loop
+    user = await asyncio.to_thread(get_user_by_email, db, email=form_data.username)
+    password_ok = user is not None and await asyncio.to_thread(
+        verify_and_upgrade_password, db, user, form_data.password
+    )
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -251,58 +499,49 @@ async def login_for_access_token(
 
 
 @app.get("/users/me", response_model=UserSchema)
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: UserSchema = Depends(get_current_user)):
     return current_user
 
 
 @app.post("/notes", response_model=NoteSchema, status_code=status.HTTP_201_CREATED)
-def create_note(
-    note: NoteCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    return create_note_for_user(db=db, note=note, user_id=current_user.id)
+async def create_note(note: NoteCreate, current_user: UserSchema = Depends(get_current_user)):
+    return await note_writer.submit(create_note_for_user, note=note, user_id=current_user.id)
 
 
 @app.get("/notes", response_model=List[NoteSchema])
 def read_notes(
-    current_user: User = Depends(get_current_user),
+    request: Request,
+    response: Response,
+    current_user: UserSchema = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    notes = get_notes_for_user(db, user_id=current_user.id)
-    # Map the Note model to NoteSchema, ensuring userId is included
-    return [
-        NoteSchema(
-            id=note.id,
-            title=note.title,
-            content=note.content,
-            created_on=note.created_on,
-            last_update=note.last_update,
-            userId=note.owner_id
-        ) for note in notes
-    ]
+    etag = get_notes_etag(db, user_id=current_user.id)
+    # Clients must revalidate, but an unchanged list costs only the aggregate query
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    response.headers.update(cache_headers)
+    rows = get_notes_for_user(db, user_id=current_user.id)
+    return [NoteSchema.model_validate(row) for row in rows]
 
 
 @app.put("/notes/{note_id}", response_model=NoteSchema)
-def update_user_note(
+async def update_user_note(
     note_id: int,
     note: NoteUpdate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: UserSchema = Depends(get_current_user)
 ):
-    updated_note = update_note(db=db, note_id=note_id, note_update=note, user_id=current_user.id)
+    updated_note = await note_writer.submit(
+        update_note, note_id=note_id, note_update=note, user_id=current_user.id
+    )
     if updated_note is None:
         raise HTTPException(status_code=404, detail="Note not found")
     return updated_note
 
 
 @app.delete("/notes/{note_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user_note(
-    note_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    success = delete_note(db=db, note_id=note_id, user_id=current_user.id)
+async def delete_user_note(note_id: int, current_user: UserSchema = Depends(get_current_user)):
+    success = await note_writer.submit(delete_note, note_id=note_id, user_id=current_user.id)
     if not success:
         raise HTTPException(status_code=404, detail="Note not found")
     return
\ No newline at end of file